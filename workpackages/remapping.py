@@ -75,9 +75,10 @@ def remap_table_master_to_wp(cursor, table_name, wp_name):
     else:
         new_wp_fid += 1
 
-    for master_fid in master_fids_missing:
-        cursor.execute(f"""INSERT INTO {remap_table_escaped} VALUES (?, ?)""", (master_fid, new_wp_fid))
-        new_wp_fid += 1
+    cursor.executemany(
+        f"""INSERT INTO {remap_table_escaped} VALUES (?, ?)""",
+        zip(master_fids_missing, range(new_wp_fid, new_wp_fid + len(master_fids_missing))),
+    )
 
     # 3. remap master ids to WP ids
     mapping = []
@@ -91,11 +92,10 @@ def remap_table_master_to_wp(cursor, table_name, wp_name):
     # hack to hopefully avoid possible pkey violations ... who would use negative ids? :-)
     cursor.execute(f"""UPDATE {table_name_escaped} SET {pkey_column_escaped} = -{pkey_column_escaped};""")
 
-    for master_fid, wp_fid in mapping:
-        cursor.execute(
-            f"""UPDATE {table_name_escaped} SET {pkey_column_escaped} = ? WHERE {pkey_column_escaped} = ?""",
-            (wp_fid, -master_fid),
-        )
+    cursor.executemany(
+        f"""UPDATE {table_name_escaped} SET {pkey_column_escaped} = ? WHERE {pkey_column_escaped} = ?""",
+        ((wp_fid, -master_fid) for master_fid, wp_fid in mapping),
+    )
 
 
 def remap_table_wp_to_master(cursor, table_name, wp_name, new_master_fid):
@@ -105,6 +105,8 @@ def remap_table_wp_to_master(cursor, table_name, wp_name, new_master_fid):
     For each row:
     - remap row exists for wp_fid -> use master_fid
     - remap does not exist for wp_fid -> insert ([first unused master fid], wp_fid)
+
+    Returns the first master fid that is still unused after the newly inserted mappings.
     """
 
     remap_table = remap_table_name(table_name, wp_name)
@@ -123,9 +125,11 @@ def remap_table_wp_to_master(cursor, table_name, wp_name, new_master_fid):
         wp_fids_missing.add(row[0])
 
     # 2. insert missing mapped ids
-    for wp_fid in wp_fids_missing:
-        cursor.execute(f"""INSERT INTO {remap_table} VALUES (?, ?)""", (new_master_fid, wp_fid))
-        new_master_fid += 1
+    cursor.executemany(
+        f"""INSERT INTO {remap_table} VALUES (?, ?)""",
+        zip(range(new_master_fid, new_master_fid + len(wp_fids_missing)), wp_fids_missing),
+    )
+    new_master_fid += len(wp_fids_missing)
 
     # 3. remap WP ids to master ids
     mapping = []  # list of tuples (wp_fid, master_fid)
@@ -139,7 +143,9 @@ def remap_table_wp_to_master(cursor, table_name, wp_name, new_master_fid):
     # hack to hopefully avoid possible pkey violations ... who would use negative ids? :-)
     cursor.execute(f"""UPDATE {table_name_escaped} SET {pkey_column_escaped} = -{pkey_column_escaped};""")
 
-    for wp_fid, master_fid in mapping:
-        cursor.execute(
-            f"""UPDATE {table_name_escaped} SET {pkey_column_escaped} = ? WHERE fid = ?""", (master_fid, -wp_fid)
-        )
+    cursor.executemany(
+        f"""UPDATE {table_name_escaped} SET {pkey_column_escaped} = ? WHERE fid = ?""",
+        ((master_fid, -wp_fid) for wp_fid, master_fid in mapping),
+    )
+
+    return new_master_fid
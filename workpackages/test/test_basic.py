@@ -129,6 +129,36 @@ def test_first_run():
     _assert_row_counts(os.path.join(output_dir, "Emma.gpkg"), expected_farms=2, expected_trees=6)
 
 
+def test_first_run_no_foreign_data():
+    """Checks that WP databases do not contain any data of other WPs and that they are compact"""
+    tmp_dir = _make_initial_farm_work_packages(os.path.join(this_dir, "config-farm-basic.yml"))
+    output_dir = os.path.join(tmp_dir.name, "output")
+
+    farm_names = {"Kyle": ["Melody Orchard"], "Emma": ["Oasis Gardens", "Tranquility Estate"]}
+    all_farm_names = farm_names["Kyle"] + farm_names["Emma"] + ["Rainbow Farm"]
+    for wp_name, wp_farm_ids in [("Kyle", [4]), ("Emma", [1, 2])]:
+        wp_gpkg = os.path.join(output_dir, wp_name + ".gpkg")
+        db = sqlite3.connect(wp_gpkg)
+        assert sorted(row[0] for row in db.execute("SELECT name FROM farms")) == farm_names[wp_name]
+        assert {row[0] for row in db.execute("SELECT DISTINCT farm_id FROM trees")} == set(wp_farm_ids)
+        db.close()
+
+        # deleted rows must not be left anywhere in the file (e.g. in free pages)
+        with open(wp_gpkg, "rb") as f:
+            content = f.read()
+        for farm_name in all_farm_names:
+            assert (farm_name.encode() in content) == (farm_name in farm_names[wp_name])
+
+        # the file should be about as small as a fully vacuumed copy
+        vacuumed_gpkg = os.path.join(tmp_dir.name, wp_name + "-vacuumed.gpkg")
+        shutil.copy(wp_gpkg, vacuumed_gpkg)
+        db = sqlite3.connect(vacuumed_gpkg)
+        db.execute("PRAGMA auto_vacuum=NONE")
+        db.execute("VACUUM")
+        db.close()
+        assert os.path.getsize(wp_gpkg) <= os.path.getsize(vacuumed_gpkg) * 1.1
+
+
 def test_first_run_filtering_geom():
     """Checks whether the first run correctly generates work package data with 'filter-geometry' method"""
     tmp_dir = _make_initial_farm_work_packages(os.path.join(this_dir, "config-farm-geom.yml"))
@@ -340,6 +370,47 @@ def test_insert_row_wp1_wp2():
     _assert_row_exists(os.path.join(output_dir, "Emma.gpkg"), "trees", 1000006)
 
 
+def test_insert_row_wp1_wp2_remap():
+    """Rows inserted into the same table in two WPs get distinct master fids that match the remap DB"""
+    config_file = os.path.join(this_dir, "config-farm-basic.yml")
+    tmp_dir_1 = _make_initial_farm_work_packages(config_file)
+    tmp_dir_2 = _prepare_next_run_work_packages(tmp_dir_1)
+
+    open_layer_and_create_feature(
+        os.path.join(tmp_dir_2.name, "input", "Emma.gpkg"), "trees", "POINT(7 17)", {"tree_species_id": 2, "farm_id": 2}
+    )
+    open_layer_and_create_feature(
+        os.path.join(tmp_dir_2.name, "input", "Kyle.gpkg"), "trees", "POINT(6 16)", {"tree_species_id": 1, "farm_id": 4}
+    )
+
+    wp_config = load_config_from_yaml(config_file)
+    make_work_packages(tmp_dir_2.name, wp_config)
+    output_dir = os.path.join(tmp_dir_2.name, "output")
+
+    db = sqlite3.connect(os.path.join(output_dir, "master.gpkg"))
+    db.execute("ATTACH ? AS remap", (os.path.join(output_dir, "remap.db"),))
+    master_rows = {row[0]: row[1:] for row in db.execute("SELECT fid, tree_species_id, farm_id FROM trees")}
+    assert len(master_rows) == 11
+    new_master_fids = []
+    for wp_name, new_wp_fid, expected_row in [("Kyle", 1000002, (1, 4)), ("Emma", 1000006, (2, 2))]:
+        remap_table = escape_double_quotes("trees_" + wp_name)
+        mapping = {row[1]: row[0] for row in db.execute(f"SELECT master_fid, wp_fid FROM remap.{remap_table}")}
+        # master fids of rows inserted in this run come after those of the first run
+        assert mapping[new_wp_fid] > 9
+        assert master_rows[mapping[new_wp_fid]] == expected_row
+        new_master_fids.append(mapping[new_wp_fid])
+
+        # every WP row is mapped to the master row with the same data
+        wp_db = sqlite3.connect(os.path.join(output_dir, wp_name + ".gpkg"))
+        wp_rows = {row[0]: row[1:] for row in wp_db.execute("SELECT fid, tree_species_id, farm_id FROM trees")}
+        wp_db.close()
+        assert set(mapping.keys()) == set(wp_rows.keys())
+        for wp_fid, master_fid in mapping.items():
+            assert master_rows[master_fid] == wp_rows[wp_fid]
+    db.close()
+    assert new_master_fids[0] != new_master_fids[1]
+
+
 def test_insert_row_master_wp():
     """One row inserted in master, on row in the same table inserted in WP"""
     config_file = os.path.join(this_dir, "config-farm-basic.yml")
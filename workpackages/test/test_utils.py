@@ -0,0 +1,276 @@
+import errno
+import os
+import time
+from tempfile import TemporaryDirectory
+
+from .. import wp_utils
+from ..wp_mergin import get_master_project_files, remove_trash_dirs, trash_tmp_dir
+from ..wp_utils import copy_file, evict_cache, link_file, touch_cache_entry
+
+
+def _write_file(filename, content):
+    with open(filename, "wb") as f:
+        f.write(content)
+
+
+def _read_file(filename):
+    with open(filename, "rb") as f:
+        return f.read()
+
+
+def test_copy_file_range_copying_nothing(monkeypatch):
+    """Checks that copy_file() falls back to a regular copy if copy_file_range() does not copy any data"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    src = os.path.join(tmp_dir.name, "src.gpkg")
+    dst = os.path.join(tmp_dir.name, "dst.gpkg")
+    content = os.urandom(100000)
+    _write_file(src, content)
+
+    # some file systems (e.g. FUSE or procfs) just return zero instead of failing
+    monkeypatch.setattr(wp_utils, "_clone_file", lambda src, dst: False)
+    monkeypatch.setattr(os, "copy_file_range", lambda *args, **kwargs: 0, raising=False)
+
+    assert not wp_utils._copy_file_range(src, dst)
+    copy_file(src, dst)
+    assert _read_file(dst) == content
+
+
+def _make_cached_project(cache_dir, project_path, size, last_used):
+    """Creates a fake cached project directory with a single file of the given size"""
+    project_cache_dir = wp_utils._project_cache_dir(cache_dir, project_path)
+    os.makedirs(project_cache_dir)
+    _write_file(os.path.join(project_cache_dir, "data.gpkg"), b"x" * size)
+    touch_cache_entry(cache_dir, project_path)
+    db = wp_utils._open_cache_index(cache_dir)
+    db.execute("UPDATE entries SET last_used = ? WHERE project_path = ?", (last_used, project_path))
+    db.close()
+    return project_cache_dir
+
+
+def test_evict_cache_order():
+    """Checks that least recently used projects get removed from the cache first, including projects
+    cached by older versions of the tool (not in the index)"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    cache_dir = tmp_dir.name
+    now = time.time()
+    dir_a = _make_cached_project(cache_dir, "martin/a", 1000, now - 300)
+    dir_b = _make_cached_project(cache_dir, "martin/b", 1000, now - 100)
+    dir_c = _make_cached_project(cache_dir, "martin/c", 1000, now - 200)
+    dir_legacy = os.path.join(cache_dir, "martin_legacy")
+    os.makedirs(dir_legacy)
+    _write_file(os.path.join(dir_legacy, "data.gpkg"), b"x" * 1000)
+    os.utime(dir_legacy, (now - 400, now - 400))
+
+    evict_cache(cache_dir, 2500, now)
+
+    assert not os.path.exists(dir_legacy)
+    assert not os.path.exists(dir_a)
+    assert os.path.exists(dir_b)
+    assert os.path.exists(dir_c)
+
+    evict_cache(cache_dir, 1000, now)
+
+    assert not os.path.exists(dir_c)
+    assert os.path.exists(dir_b)
+    db = wp_utils._open_cache_index(cache_dir)
+    assert db.execute("SELECT project_path FROM entries").fetchall() == [("martin/b",)]
+    db.close()
+
+
+def test_evict_cache_used_since():
+    """Checks that projects used in the current run are kept in the cache even if it exceeds the limit"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    cache_dir = tmp_dir.name
+    start_time = time.time()
+    dir_old = _make_cached_project(cache_dir, "martin/old", 1000, start_time - 100)
+    dir_a = _make_cached_project(cache_dir, "martin/a", 1000, start_time - 100)
+    dir_b = _make_cached_project(cache_dir, "martin/b", 1000, start_time - 100)
+
+    # e.g. WP projects not modified since the last run are only touched, not downloaded
+    touch_cache_entry(cache_dir, "martin/a")
+    touch_cache_entry(cache_dir, "martin/b")
+
+    evict_cache(cache_dir, 0, start_time)
+
+    assert not os.path.exists(dir_old)
+    assert os.path.exists(dir_a)
+    assert os.path.exists(dir_b)
+
+
+def _make_project_dir(directory):
+    """Creates a directory looking like a downloaded Mergin Maps project"""
+    os.makedirs(os.path.join(directory, ".mergin"))
+    os.makedirs(os.path.join(directory, "photos"))
+    _write_file(os.path.join(directory, "farms.gpkg"), b"farms")
+    _write_file(os.path.join(directory, "photos", "img.jpg"), b"photo")
+    _write_file(os.path.join(directory, ".mergin", "mergin.json"), b"{}")
+    _write_file(os.path.join(directory, ".mergin", "farms.gpkg"), b"farms")
+
+
+def _same_inode(path1, path2):
+    return os.stat(path1).st_ino == os.stat(path2).st_ino
+
+
+def _raise_exdev(src, dst, **kwargs):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), src, None, dst)
+
+
+def test_link_tree():
+    """Checks that project files get hard-linked from the cache, except for .mergin directory that gets copied"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    src_dir = os.path.join(tmp_dir.name, "cache")
+    dst_dir = os.path.join(tmp_dir.name, "project")
+    _make_project_dir(src_dir)
+
+    wp_utils._link_tree(src_dir, dst_dir)
+
+    for filename in ["farms.gpkg", os.path.join("photos", "img.jpg")]:
+        assert _same_inode(os.path.join(src_dir, filename), os.path.join(dst_dir, filename))
+    for filename in ["mergin.json", "farms.gpkg"]:
+        src = os.path.join(src_dir, ".mergin", filename)
+        dst = os.path.join(dst_dir, ".mergin", filename)
+        assert not _same_inode(src, dst)
+        assert _read_file(src) == _read_file(dst)
+
+
+def test_link_tree_cross_device(monkeypatch):
+    """Checks that files get copied if they cannot be hard-linked (e.g. cache is on another file system)"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    src_dir = os.path.join(tmp_dir.name, "cache")
+    dst_dir = os.path.join(tmp_dir.name, "project")
+    _make_project_dir(src_dir)
+    monkeypatch.setattr(os, "link", _raise_exdev)
+
+    wp_utils._link_tree(src_dir, dst_dir)
+
+    for filename in ["farms.gpkg", os.path.join("photos", "img.jpg"), os.path.join(".mergin", "mergin.json")]:
+        src = os.path.join(src_dir, filename)
+        dst = os.path.join(dst_dir, filename)
+        assert not _same_inode(src, dst)
+        assert _read_file(src) == _read_file(dst)
+
+
+def test_link_file():
+    """Checks that link_file() replaces an existing destination and does nothing if it is linked already"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    src = os.path.join(tmp_dir.name, "src.gpkg")
+    dst = os.path.join(tmp_dir.name, "dst.gpkg")
+    _write_file(src, b"new")
+    _write_file(dst, b"old")
+
+    link_file(src, dst)
+    assert _same_inode(src, dst)
+    assert _read_file(dst) == b"new"
+
+    dst_stat = os.stat(dst)
+    link_file(src, dst)
+    assert os.stat(dst).st_ino == dst_stat.st_ino
+    assert os.stat(src).st_nlink == 2
+
+
+def test_link_file_cross_device(monkeypatch):
+    """Checks that link_file() falls back to a copy if the file cannot be hard-linked"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    src = os.path.join(tmp_dir.name, "src.gpkg")
+    dst = os.path.join(tmp_dir.name, "dst.gpkg")
+    _write_file(src, b"new")
+    _write_file(dst, b"old")
+    monkeypatch.setattr(os, "link", _raise_exdev)
+
+    link_file(src, dst)
+
+    assert not _same_inode(src, dst)
+    assert _read_file(dst) == b"new"
+
+
+def test_copy_file_over_link():
+    """Checks that writing to a file replaced by copy_file() does not modify the cached file it was linked to"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    src_dir = os.path.join(tmp_dir.name, "cache")
+    dst_dir = os.path.join(tmp_dir.name, "project")
+    _make_project_dir(src_dir)
+    wp_utils._link_tree(src_dir, dst_dir)
+    new_file = os.path.join(tmp_dir.name, "new.gpkg")
+    _write_file(new_file, b"new farms")
+
+    dst = os.path.join(dst_dir, "farms.gpkg")
+    copy_file(new_file, dst)
+    with open(dst, "ab") as f:
+        f.write(b" modified")
+
+    assert _read_file(dst) == b"new farms modified"
+    assert _read_file(new_file) == b"new farms"
+    assert _read_file(os.path.join(src_dir, "farms.gpkg")) == b"farms"
+
+
+def test_get_master_project_files():
+    """Checks which files of the master project get copied to new WP projects"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    master_dir = os.path.join(tmp_dir.name, "master")
+    for filename in [
+        "farms.gpkg",
+        "project.qgz",
+        "mergin-work-packages.yml",
+        ".hidden.txt",
+        ".mergin/mergin.json",
+        ".mergin/farms.gpkg",
+        "work-packages/Kyle.gpkg",
+        "work-packages/last_run.json",
+        "work-packages-old/Emma.gpkg",
+        "work-packages.txt",
+        "photos/img1.jpg",
+        "photos/.thumbnails/img1.jpg",
+        "photos/2023/img2.jpg",
+        "photos/2023/mergin-work-packages.yml",
+        "photos/work-packages/img3.jpg",
+        ".git/config",
+        "shared/data.csv",
+    ]:
+        path = os.path.join(master_dir, filename)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_file(path, b"data")
+    os.symlink(os.path.join(master_dir, "shared"), os.path.join(master_dir, "linked"))
+    os.symlink(os.path.join(master_dir, "missing.txt"), os.path.join(master_dir, "broken.txt"))
+
+    files = get_master_project_files(master_dir)
+
+    assert isinstance(files, list)
+    expected_files = [
+        os.path.normpath(f)
+        for f in [
+            "farms.gpkg",
+            "project.qgz",
+            "photos/img1.jpg",
+            "photos/2023/img2.jpg",
+            "photos/2023/mergin-work-packages.yml",
+            "photos/work-packages/img3.jpg",
+            "shared/data.csv",
+            "linked/data.csv",
+        ]
+    ]
+    assert sorted(files) == sorted(expected_files)
+
+    # directories that cannot be listed are skipped like glob does - a symlink loop ends with ELOOP
+    os.symlink("..", os.path.join(master_dir, "photos", "up"))
+    files = get_master_project_files(master_dir)
+    assert set(expected_files) < set(files)
+    assert os.path.join("photos", "up", "farms.gpkg") in files
+    assert os.path.join("photos", "up", "photos", "up", "photos", "img1.jpg") in files
+
+
+def test_trash_tmp_dir():
+    """Checks that temporary directories moved aside at the end of a run get removed by the next run"""
+    tmp_dir = TemporaryDirectory(prefix="test-mergin-work-packages-")
+    run_dir_1 = os.path.join(tmp_dir.name, "mergin-work-packages-run1")
+    run_dir_2 = os.path.join(tmp_dir.name, "mergin-work-packages-run2")
+    for run_dir in [run_dir_1, run_dir_2]:
+        os.makedirs(os.path.join(run_dir, "master"))
+        _write_file(os.path.join(run_dir, "master", "farms.gpkg"), b"farms")
+
+    trash_tmp_dir(run_dir_1)
+    assert not os.path.exists(run_dir_1)
+    assert len(os.listdir(tmp_dir.name)) == 2
+
+    # the directory of a run in progress must be left alone
+    remove_trash_dirs(tmp_dir.name)
+    assert os.listdir(tmp_dir.name) == ["mergin-work-packages-run2"]
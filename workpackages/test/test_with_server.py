@@ -1,13 +1,22 @@
 import pytest
+import json
 import os
 import shutil
 import sqlite3
 import tempfile
+import yaml
 
 from mergin import MerginClient, ClientError, MerginProject
 
-from ..wp_mergin import run_wp_mergin_with_context, MerginWPContext
-from ..wp_utils import escape_double_quotes
+from ..wp import make_work_packages
+from ..wp_mergin import (
+    initialize,
+    prepare_inputs,
+    push_data_to_projects,
+    run_wp_mergin_with_context,
+    MerginWPContext,
+)
+from ..wp_utils import escape_double_quotes, file_checksum
 from .init_test_data import create_farm_dataset, open_layer_and_update_feature
 
 SERVER_URL = os.environ.get("TEST_MERGIN_URL")
@@ -195,3 +204,180 @@ def test_wp_1(mc: MerginClient):
 
     _assert_value_equals(os.path.join(project_dir_master, "farms.gpkg"), "trees", 3, "age_years", 5)
     _assert_value_equals(os.path.join(project_dir_emma, "farms.gpkg"), "trees", 1000002, "age_years", 5)
+
+
+def _last_run(project_dir_master):
+    """Returns content of the state file written by the last run of the tool"""
+    with open(os.path.join(project_dir_master, "work-packages", "last_run.json")) as f:
+        return json.load(f)
+
+
+def test_wp_last_run(mc: MerginClient):
+    """Test that WP projects not modified since the last run are not downloaded (or pushed) unless needed,
+    based on the state recorded in work-packages/last_run.json in the master project."""
+
+    project_master_name = "farms-lr-master"
+    project_kyle_name = "farms-lr-Kyle"
+    project_emma_name = "farms-lr-Emma"
+    project_master_full = API_USER + "/" + project_master_name
+    project_kyle_full = API_USER + "/" + project_kyle_name
+    project_emma_full = API_USER + "/" + project_emma_name
+    project_dir_master = os.path.join(TMP_DIR, "wp-edits-lr", project_master_name)
+    project_dir_kyle = os.path.join(TMP_DIR, "wp-edits-lr", project_kyle_name)
+    project_dir_emma = os.path.join(TMP_DIR, "wp-edits-lr", project_emma_name)
+    cache_dir = os.path.join(TMP_DIR, "wp-cache-lr")
+
+    remove_folders([cache_dir])
+    cleanup(mc, project_master_full, [project_dir_master])
+    cleanup(mc, project_kyle_full, [project_dir_kyle])
+    cleanup(mc, project_emma_full, [project_dir_emma])
+
+    # add WP configuration and initial farms dataset
+    os.makedirs(project_dir_master, exist_ok=True)
+    config_yaml = os.path.join(project_dir_master, "mergin-work-packages.yml")
+    with open(os.path.join(this_dir, "config-farm-basic.yml"), "r") as file:
+        filedata = file.read()
+        filedata = filedata.replace("martin/farms-", API_USER + "/farms-lr-")
+    with open(config_yaml, "w") as file:
+        file.write(filedata)
+
+    create_farm_dataset(os.path.join(project_dir_master, "farms.gpkg"))
+    mc.create_project_and_push(project_master_full, project_dir_master)
+
+    ctx = MerginWPContext()
+    ctx.mergin_url = SERVER_URL
+    ctx.mergin_user = API_USER
+    ctx.mergin_password = USER_PWD
+    ctx.master_mergin_project = project_master_full
+    ctx.cache_dir = cache_dir
+
+    #
+    # initial run - the state of WP projects gets recorded
+    #
+
+    run_wp_mergin_with_context(ctx)
+
+    mc.pull_project(project_dir_master)
+    mc.download_project(project_kyle_full, project_dir_kyle)
+    mc.download_project(project_emma_full, project_dir_emma)
+
+    last_run = _last_run(project_dir_master)
+    assert set(last_run.keys()) == {"Kyle", "Emma"}
+    for wp_name in ["Kyle", "Emma"]:
+        assert last_run[wp_name]["version"] == "v1"
+        wp_base_file = os.path.join(project_dir_master, "work-packages", wp_name + ".gpkg")
+        assert last_run[wp_name]["checksum"] == file_checksum(wp_base_file)
+
+    #
+    # run again after no operation - WP projects are neither downloaded nor pushed
+    #
+
+    run_wp_mergin_with_context(ctx)
+
+    assert ctx.wp_unchanged == {"Kyle", "Emma"}
+
+    mc.pull_project(project_dir_kyle)
+    mc.pull_project(project_dir_emma)
+    assert project_version(project_dir_kyle) == "v1"
+    assert project_version(project_dir_emma) == "v1"
+
+    #
+    # version mismatch: a change pushed to a WP project means it has to be downloaded
+    #
+
+    open_layer_and_update_feature(os.path.join(project_dir_kyle, "farms.gpkg"), "trees", 1000000, {"age_years": 10})
+    mc.push_project(project_dir_kyle)
+
+    run_wp_mergin_with_context(ctx)
+
+    assert ctx.wp_unchanged == {"Emma"}
+
+    mc.pull_project(project_dir_master)
+    mc.pull_project(project_dir_kyle)
+    mc.pull_project(project_dir_emma)
+    assert project_version(project_dir_kyle) == "v2"
+    assert project_version(project_dir_emma) == "v1"
+    _assert_value_equals(os.path.join(project_dir_master, "farms.gpkg"), "trees", 8, "age_years", 10)
+    assert _last_run(project_dir_master)["Kyle"]["version"] == "v2"
+
+    #
+    # checksum mismatch: the base file does not match the recorded state, so the WP project has to be downloaded
+    #
+
+    last_run_file = os.path.join(project_dir_master, "work-packages", "last_run.json")
+    last_run = _last_run(project_dir_master)
+    emma_checksum = last_run["Emma"]["checksum"]
+    last_run["Emma"]["checksum"] = "0" * 64
+    with open(last_run_file, "w") as f:
+        json.dump(last_run, f)
+    mc.push_project(project_dir_master)
+
+    run_wp_mergin_with_context(ctx)
+
+    assert ctx.wp_unchanged == {"Kyle"}
+
+    mc.pull_project(project_dir_master)
+    mc.pull_project(project_dir_emma)
+    assert project_version(project_dir_emma) == "v1"  # nothing to push, just downloaded
+    assert _last_run(project_dir_master)["Emma"]["checksum"] == emma_checksum
+
+    #
+    # changed output of an unchanged WP: the project gets downloaded late and the new data pushed
+    #
+
+    open_layer_and_update_feature(os.path.join(project_dir_master, "farms.gpkg"), "trees", 3, {"age_years": 5})
+    mc.push_project(project_dir_master)
+
+    run_wp_mergin_with_context(ctx)
+
+    assert ctx.wp_unchanged == {"Kyle", "Emma"}
+
+    mc.pull_project(project_dir_master)
+    mc.pull_project(project_dir_kyle)
+    mc.pull_project(project_dir_emma)
+    assert project_version(project_dir_kyle) == "v2"
+    assert project_version(project_dir_emma) == "v2"
+    _assert_value_equals(os.path.join(project_dir_emma, "farms.gpkg"), "trees", 1000002, "age_years", 5)
+    last_run = _last_run(project_dir_master)
+    assert last_run["Emma"]["version"] == "v2"
+    assert last_run["Emma"]["checksum"] == file_checksum(os.path.join(project_dir_master, "work-packages", "Emma.gpkg"))
+
+    #
+    # WP project modified while the tool is running (only possible without locking): the run has to fail
+    #
+
+    open_layer_and_update_feature(os.path.join(project_dir_master, "farms.gpkg"), "trees", 3, {"age_years": 6})
+    mc.push_project(project_dir_master)
+
+    ctx.skip_lock = True
+    initialize(ctx)
+    wp_config, wp_new, gpkg_path, master_project_files = prepare_inputs(ctx)
+    assert "Emma" in ctx.wp_unchanged
+    make_work_packages(ctx.wp_alg_dir, wp_config, ctx.max_workers)
+
+    open_layer_and_update_feature(os.path.join(project_dir_emma, "farms.gpkg"), "trees", 1000000, {"age_years": 20})
+    mc.push_project(project_dir_emma)
+    assert project_version(project_dir_emma) == "v3"
+
+    with pytest.raises(ClientError, match="has been modified during the run"):
+        push_data_to_projects(ctx, wp_config, wp_new, gpkg_path, master_project_files)
+    shutil.rmtree(ctx.tmp_dir)
+    ctx.skip_lock = False
+
+    #
+    # removed WP: its entry is pruned from the recorded state
+    #
+
+    mc.pull_project(project_dir_master)
+    with open(config_yaml, "r") as file:
+        config = yaml.safe_load(file)
+    config["work-packages"] = [wp for wp in config["work-packages"] if wp["name"] != "Emma"]
+    with open(config_yaml, "w") as file:
+        yaml.safe_dump(config, file)
+    mc.push_project(project_dir_master)
+
+    run_wp_mergin_with_context(ctx)
+
+    mc.pull_project(project_dir_master)
+    assert set(_last_run(project_dir_master).keys()) == {"Kyle"}
+    assert not os.path.exists(os.path.join(project_dir_master, "work-packages", "Emma.gpkg"))
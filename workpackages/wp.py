@@ -4,15 +4,17 @@ Combined split/merge algorithm that:
 2. Regenerates work packages based on the master database
 """
 
+import filecmp
 import sqlite3
 import os
 import shutil
+import threading
 import pygeodiff
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 
-from .wp_utils import escape_double_quotes
+from .wp_utils import copy_file, escape_double_quotes
 from .remapping import remap_table_master_to_wp, remap_table_wp_to_master
 
 # Layout of files:
@@ -35,8 +37,11 @@ from .remapping import remap_table_master_to_wp, remap_table_wp_to_master
 #   WP1-input-output.diff   -- difference between "input" and "output" (collated changes to be applied to the WP)
 
 
-# set to True when testing/debugging temporary diffs
-DEBUG_DIFFS = False
+# use the much faster libyaml-based parser if PyYAML has been built with it
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# set to True (or set WP_DEBUG_DIFFS=1 environment variable) when testing/debugging temporary diffs
+DEBUG_DIFFS = os.environ.get("WP_DEBUG_DIFFS") == "1"
 
 
 class WPTable(object):
@@ -90,7 +95,7 @@ def load_config_from_yaml(config_yaml: str) -> WPConfig:
 
     with open(config_yaml, "r") as stream:
         try:
-            root_yaml = yaml.safe_load(stream)
+            root_yaml = yaml.load(stream, Loader=YAML_LOADER)
         except yaml.YAMLError as exc:
             raise ValueError("Unable to parse config YAML:\n" + str(exc))
         master_gpkg = root_yaml["file"]
@@ -103,7 +108,22 @@ def load_config_from_yaml(config_yaml: str) -> WPConfig:
         return WPConfig(master_gpkg, wp_names, wp_tables)
 
 
-def make_work_packages(data_dir: str, wp_config: WPConfig) -> None:
+def _open_spatialite(path, remap_db=None):
+    """
+    Opens a GPKG with spatialite loaded and (optionally) the remapping DB attached as "remap".
+    The file gets memory-mapped, so that reads do not need to go through buffered I/O.
+    """
+    db = sqlite3.connect(path, isolation_level=None)  # transactions are handled explicitly with BEGIN/COMMIT
+    db.enable_load_extension(True)  # for spatialite
+    c = db.cursor()
+    c.execute("SELECT load_extension('mod_spatialite');")  # TODO: how to deal with it?
+    c.execute("PRAGMA mmap_size=30000000000")
+    if remap_db is not None:
+        c.execute("ATTACH ? AS remap", (remap_db,))
+    return db
+
+
+def make_work_packages(data_dir: str, wp_config: WPConfig, max_workers=None) -> None:
     """
     This is the core part of the algorithm for merging and splitting data for work packages.
     It expects a data directory with layout of directories and files as described in the header
@@ -111,7 +131,8 @@ def make_work_packages(data_dir: str, wp_config: WPConfig) -> None:
 
     The first stage collects changes from the master DB and the work package DBs and
     combines them together, resolving any conflicts. At the end of the first stage we have
-    updated master database. The second stage then re-creates individual work package DBs.
+    updated master database. The second stage then re-creates individual work package DBs
+    (in parallel, using up to max_workers threads).
     """
 
     base_dir = os.path.join(data_dir, "base")  # where the non-modified GPKGs from the last run should be
@@ -131,41 +152,45 @@ def make_work_packages(data_dir: str, wp_config: WPConfig) -> None:
         []
     )  # names of WPs that have been processed before (and we expect their GPKGs exist and may be modified)
     if os.path.exists(base_dir):
-        for path in Path(base_dir).iterdir():
-            filename = path.name
-            if filename == "master.gpkg":
-                continue  # skip the master file - it's not a work package
-            if filename.endswith(".gpkg"):
-                wp_name = filename[:-5]  # strip the suffix
-                old_wp_names.append(wp_name)
+        with os.scandir(base_dir) as entries:
+            for entry in entries:
+                filename = entry.name
+                if filename == "master.gpkg":
+                    continue  # skip the master file - it's not a work package
+                if filename.endswith(".gpkg") and entry.is_file():
+                    wp_name = filename[:-5]  # strip the suffix
+                    old_wp_names.append(wp_name)
     print("existing WPs: " + str(old_wp_names))
 
     def _logger_callback(level, text_bytes):
         text = text_bytes.decode()  # convert bytes to str
         print("GEODIFF: ", text)
 
-    geodiff = pygeodiff.GeoDiff()
+    def _create_geodiff():
+        geodiff = pygeodiff.GeoDiff()
+
+        # set up logging to get extra info from geodiff.
+        # geodiff.LevelDebug may be useful for debugging but it's too much info in most cases
+        geodiff.set_maximum_logger_level(geodiff.LevelInfo)
+        geodiff.set_logger_callback(_logger_callback)
+        return geodiff
 
-    # set up logging to get extra info from geodiff.
-    # geodiff.LevelDebug may be useful for debugging but it's too much info in most cases
-    geodiff.set_maximum_logger_level(geodiff.LevelInfo)
-    geodiff.set_logger_callback(_logger_callback)
+    geodiff = _create_geodiff()
 
     master_gpkg_base = os.path.join(base_dir, "master.gpkg")  # should not have been modified
     master_gpkg_input = os.path.join(input_dir, "master.gpkg")  # this could have been modified by users
     master_gpkg_output = os.path.join(output_dir, "master.gpkg")  # does not exist yet
 
-    if os.path.exists(master_gpkg_base):
+    if DEBUG_DIFFS and os.path.exists(master_gpkg_base):
         # summarize changes that have happened in master (base master VS input master)
         # (this is not needed anywhere in the code, but may be useful for debugging)
         master_base_to_input = os.path.join(tmp_dir, "master-base-input.diff")
         master_base_to_input_json = os.path.join(tmp_dir, "master-base-input.json")
         geodiff.create_changeset(master_gpkg_base, master_gpkg_input, master_base_to_input)
-        if DEBUG_DIFFS:
-            geodiff.list_changes(master_base_to_input, master_base_to_input_json)
+        geodiff.list_changes(master_base_to_input, master_base_to_input_json)
 
     # create new master_gpkg in the output directory
-    shutil.copy(master_gpkg_input, master_gpkg_output)
+    copy_file(master_gpkg_input, master_gpkg_output)
 
     # copy "base" remapping DB to "output" where we may be adding some more entries
     remap_db_base = os.path.join(base_dir, "remap.db")
@@ -175,52 +200,58 @@ def make_work_packages(data_dir: str, wp_config: WPConfig) -> None:
     if not old_wp_names and os.path.exists(remap_db_base):
         raise ValueError("remap.db should not exist yet!")
     if os.path.exists(remap_db_base):
-        shutil.copy(remap_db_base, remap_db_output)
+        copy_file(remap_db_base, remap_db_output)
 
     print("STAGE 1 [WP -> MASTER]")
 
     # STAGE 1: Bring the changes from WPs to master
     # (remap WP database + create changeset + rebase changeset)
+    # get max. fids for tables (so that we know where to start when remapping). This is only done once:
+    # master's new rows only come from WPs, and they get master fids assigned by remapping, so we just
+    # keep track of the first unused fid as we go
+    db = sqlite3.connect(master_gpkg_output)
+    c = db.cursor()
+    new_master_fids = {}
+    for wp_table in wp_config.wp_tables:
+        wp_table_name = wp_table.name
+        wp_tab_name_esc = escape_double_quotes(wp_table_name)
+        c.execute(f"""SELECT max(fid) FROM {wp_tab_name_esc};""")
+        new_master_fid = c.fetchone()[0]
+        if new_master_fid is None:
+            new_master_fid = 1  # empty table so far
+        else:
+            new_master_fid += 1
+        new_master_fids[wp_table_name] = new_master_fid
+    c = None
+    db.close()
+
     for wp_name in old_wp_names:
         print("WP " + wp_name)
 
-        # get max. fids for tables (so that we know where to start when remapping)
-        db = sqlite3.connect(master_gpkg_output)
-        c = db.cursor()
-        new_master_fids = {}
-        for wp_table in wp_config.wp_tables:
-            wp_table_name = wp_table.name
-            wp_tab_name_esc = escape_double_quotes(wp_table_name)
-            c.execute(f"""SELECT max(fid) FROM {wp_tab_name_esc};""")
-            new_master_fid = c.fetchone()[0]
-            if new_master_fid is None:
-                new_master_fid = 1  # empty table so far
-            else:
-                new_master_fid += 1
-            new_master_fids[wp_table_name] = new_master_fid
-        c = None
-        db = None
-
         # TODO: check whether the changes in the DB are allowed (matching the deciding column)
 
         wp_gpkg_base_wp_fids = os.path.join(base_dir, wp_name + ".gpkg")  # should not have been modified by user
         wp_gpkg_input_wp_fids = os.path.join(input_dir, wp_name + ".gpkg")  # may have been modified by user
 
+        if filecmp.cmp(wp_gpkg_base_wp_fids, wp_gpkg_input_wp_fids, shallow=False):
+            # the WP file has not been touched at all -> no need to copy + remap it just to find there are no changes
+            print(" -- no changes")
+            continue
+
         wp_gpkg_base = os.path.join(tmp_dir, wp_name + "-base.gpkg")  # should not have been modified by user
         wp_gpkg_input = os.path.join(tmp_dir, wp_name + "-input.gpkg")  # may have been modified by user
-        shutil.copy(wp_gpkg_base_wp_fids, wp_gpkg_base)
-        shutil.copy(wp_gpkg_input_wp_fids, wp_gpkg_input)
+        copy_file(wp_gpkg_base_wp_fids, wp_gpkg_base)
+        copy_file(wp_gpkg_input_wp_fids, wp_gpkg_input)
 
         # re-map local fids of the WP gpkg to master fids (based on previously created mapping DB)
         for x in [wp_gpkg_base, wp_gpkg_input]:
-            db = sqlite3.connect(x)
-            db.enable_load_extension(True)  # for spatialite
+            db = _open_spatialite(x, remap_db_output)
             c = db.cursor()
-            c.execute("SELECT load_extension('mod_spatialite');")  # TODO: how to deal with it?
-            c.execute("ATTACH ? AS remap", (remap_db_output,))
             c.execute("BEGIN")
             for wp_table in wp_config.wp_tables:
-                remap_table_wp_to_master(c, wp_table.name, wp_name, new_master_fids[wp_table.name])
+                new_master_fids[wp_table.name] = remap_table_wp_to_master(
+                    c, wp_table.name, wp_name, new_master_fids[wp_table.name]
+                )
             c.execute("COMMIT")
             db.close()
 
@@ -301,8 +332,12 @@ def make_work_packages(data_dir: str, wp_config: WPConfig) -> None:
 
     # STAGE 2: Regenerate WP databases
     # (make "new" WP database + filter database based on WP + remap DB)
+    # Work packages are independent of each other, so they are processed in parallel. The only shared
+    # file is the remap DB: all access to it is serialized (each WP has its own remap tables though)
+
+    remap_db_lock = threading.Lock()
 
-    for wp in wp_config.wp_names:
+    def make_work_package(wp):
         wp_name, wp_value, wp_mergin_project = wp.name, wp.value, wp.mergin_project
 
         print("WP ", wp_name)
@@ -314,43 +349,55 @@ def make_work_packages(data_dir: str, wp_config: WPConfig) -> None:
         wp_changeset_input_to_output_json = os.path.join(output_dir, wp_name + "-input-output.json")
 
         # start from a copy of the master
-        shutil.copy(master_gpkg_output, wp_gpkg_output)
+        copy_file(master_gpkg_output, wp_gpkg_output)
 
         # filter out data that does not belong to the WP
-        # and remap fids in the DB from master to WP-local fids
-        db = sqlite3.connect(wp_gpkg_output)
-        db.enable_load_extension(True)  # for spatialite
+        db = _open_spatialite(wp_gpkg_output)
         c = db.cursor()
-        c.execute("SELECT load_extension('mod_spatialite');")  # TODO: how to deal with it?
-        c.execute("ATTACH ? AS remap", (remap_db_output,))
+        # the file is re-created on every run, so there is no need for crash safety
+        c.execute("PRAGMA main.journal_mode=MEMORY")
+        c.execute("PRAGMA main.synchronous=OFF")
+        c.execute("PRAGMA temp_store=MEMORY")
         c.execute("BEGIN")
         for wp_table in wp_config.wp_tables:
             wp_table_name = wp_table.name
             wp_filter_method = wp_table.filter_method
             wp_tab_name_esc = escape_double_quotes(wp_table_name)
             if wp_filter_method == WPTable.FILTER_METHOD_GEOMETRY:
-                intersects_query = f"ST_Intersects(GeomFromGPB(geometry), ST_GeomFromText('{wp_value}'))"
-                c.execute(f"""delete from {wp_tab_name_esc} where not {intersects_query}""")
+                intersects_query = "ST_Intersects(GeomFromGPB(geometry), ST_GeomFromText(?))"
+                c.execute(f"""delete from {wp_tab_name_esc} where not {intersects_query}""", (wp_value,))
             else:
                 wp_filter_column = wp_table.filter_column_name
                 wp_filter_column_escaped = escape_double_quotes(wp_filter_column)
-                c.execute(f"""delete from {wp_tab_name_esc} where {wp_filter_column_escaped} IS NULL""")
+                # rows with NULL are deleted within the same statement (i.e. a single pass through the table)
                 if isinstance(wp_value, (str, int, float)):
-                    c.execute(f"""delete from {wp_tab_name_esc} where {wp_filter_column_escaped} != ?""", (wp_value,))
+                    c.execute(
+                        f"""delete from {wp_tab_name_esc} """
+                        f"""where {wp_filter_column_escaped} IS NULL OR {wp_filter_column_escaped} != ?""",
+                        (wp_value,),
+                    )
                 elif isinstance(wp_value, list):
                     values_str = ",".join(["?"] * len(wp_value))
                     c.execute(
-                        f"""delete from {wp_tab_name_esc} where {wp_filter_column_escaped} not in ({values_str})""",
+                        f"""delete from {wp_tab_name_esc} """
+                        f"""where {wp_filter_column_escaped} IS NULL OR {wp_filter_column_escaped} not in ({values_str})""",
                         wp_value,
                     )
                 else:
                     # we may want to support some custom SQL at some point too
                     raise ValueError("what?")
-            remap_table_master_to_wp(c, wp_table.name, wp_name)
-
         # TODO: drop tables that are not listed at all (?)
         c.execute("COMMIT")
 
+        # remap fids in the DB from master to WP-local fids
+        with remap_db_lock:
+            c.execute("ATTACH ? AS remap", (remap_db_output,))
+            c.execute("BEGIN")
+            for wp_table in wp_config.wp_tables:
+                remap_table_master_to_wp(c, wp_table.name, wp_name)
+            c.execute("COMMIT")
+            c.execute("DETACH remap")
+
         # run VACUUM to purge anything that does not belong to the WP data
         c.execute("VACUUM")
 
@@ -360,9 +407,14 @@ def make_work_packages(data_dir: str, wp_config: WPConfig) -> None:
 
         # get changeset between the one received from WP and newly created GPKG
         if os.path.exists(wp_gpkg_input):
-            geodiff.create_changeset(wp_gpkg_input, wp_gpkg_output, wp_changeset_input_to_output)
+            wp_geodiff = _create_geodiff()
+            wp_geodiff.create_changeset(wp_gpkg_input, wp_gpkg_output, wp_changeset_input_to_output)
             if DEBUG_DIFFS:
-                geodiff.list_changes(wp_changeset_input_to_output, wp_changeset_input_to_output_json)
+                wp_geodiff.list_changes(wp_changeset_input_to_output, wp_changeset_input_to_output_json)
         else:
             # first time this WP is created...
             pass  # TODO: what to do?
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # consume the results, so that any exception raised in a worker is re-raised here
+        list(executor.map(make_work_package, wp_config.wp_names))
@@ -12,6 +12,7 @@ The config.db should contain two tables as defined in config.sql:
 After the initial run, the algorithm will add some more files:
 - work-packages/remap.db
 - work-packages/master.gpkg
+- work-packages/last_run.json
 - work-packages/<WP1>.gpkg
 - work-packages/<WP2>.gpkg
 - work-package/<...>.gpkg
@@ -20,19 +21,31 @@ These files are used internally by the algorithm and should not be modified (or
 """
 
 import getpass
-import glob
+import json
 import time
 import mergin
 import mergin.client_push
 import os
 import shutil
 import tempfile
+import threading
 import argparse
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .version import __version__
-from .wp_utils import download_project_with_cache, ProjectPadlock
+from .wp_utils import (
+    copy_file,
+    download_project_with_cache,
+    evict_cache,
+    file_checksum,
+    link_file,
+    touch_cache_entry,
+    ProjectPadlock,
+)
 from .wp import load_config_from_yaml, make_work_packages, WPConfig
 
+# prefix of temporary directories of finished runs that are waiting to be removed
+TRASH_DIR_PREFIX = "mergin-work-packages-trash-"
+
 
 class MerginWPContext:
     """Keeps the context of the current run of the tool"""
@@ -51,13 +64,24 @@ class MerginWPContext:
 
         self.tmp_dir = None
         self.cache_dir = None
+        self.cache_max_size = None  # in MB (None = unlimited)
         self.master_dir = None
+        self.master_wp_dir = None
         self.master_config_yaml = None
         self.wp_alg_dir = None
         self.wp_alg_base_dir = None
         self.wp_alg_input_dir = None
         self.wp_alg_output_dir = None
         self.project_padlock = None
+        self.start_time = None
+        self.trash_cleanup = None  # thread removing temporary directories left by previous runs
+
+        # state of WP projects after the last run: {wp_name: {"version": ..., "checksum": ...}}
+        self.last_run = None
+        # names of WPs whose projects have not been modified since the last run (and were not downloaded)
+        self.wp_unchanged = None
+        # directories of WP projects: {wp_name: path}
+        self.wp_dirs = None
 
 
 def parse_args() -> MerginWPContext:
@@ -67,12 +91,14 @@ def parse_args() -> MerginWPContext:
     parser = argparse.ArgumentParser()
     parser.add_argument("mergin_project")
     parser.add_argument("--cache-dir", nargs="?")
+    parser.add_argument("--cache-max-size", nargs="?", type=int)  # in MB
     parser.add_argument("--max-workers", nargs="?", type=int, default=8)
     parser.add_argument("--dry-run", action="store_true")
     parser.add_argument("--skip-lock", action="store_true")
     params = parser.parse_args()
     ctx.master_mergin_project = params.mergin_project  # e.g.  martin/wp-master
     ctx.cache_dir = params.cache_dir
+    ctx.cache_max_size = params.cache_max_size
     ctx.max_workers = params.max_workers
     ctx.dry_run = params.dry_run
     ctx.skip_lock = params.skip_lock
@@ -85,6 +111,8 @@ def initialize(ctx: MerginWPContext):
     if not ctx.master_mergin_project:
         raise ValueError("Need a parameter with master Mergin Maps project name")
 
+    ctx.start_time = time.time()
+
     if ctx.mergin_user is None:
         ctx.mergin_user = os.getenv("MERGIN_USERNAME")
     if ctx.mergin_user is None:
@@ -102,6 +130,9 @@ def initialize(ctx: MerginWPContext):
 
     # this will create a directory with a random name, e.g. /tmp/mergin-work-packages-w7tbsyd7
     ctx.tmp_dir = tempfile.mkdtemp(prefix="mergin-work-packages-")
+    # temporary directories of previous runs only got moved aside at their end - remove them in the background
+    ctx.trash_cleanup = threading.Thread(target=remove_trash_dirs, args=(os.path.dirname(ctx.tmp_dir),))
+    ctx.trash_cleanup.start()
 
     ctx.mc = mergin.MerginClient(
         url=ctx.mergin_url,
@@ -118,28 +149,103 @@ def initialize(ctx: MerginWPContext):
     os.makedirs(ctx.wp_alg_input_dir)
 
     ctx.master_dir = os.path.join(ctx.tmp_dir, "master")
+    ctx.master_wp_dir = os.path.join(ctx.master_dir, "work-packages")
     ctx.master_config_yaml = os.path.join(ctx.master_dir, "mergin-work-packages.yml")
-    ctx.project_padlock = ProjectPadlock(ctx.mc)
+    ctx.project_padlock = ProjectPadlock(ctx.mc, ctx.max_workers)
     return ctx
 
 
+def run_in_parallel(ctx: MerginWPContext, func, items):
+    """
+    Calls the function for each item using a pool of threads and returns list of results (in the order of items).
+    The first failure is re-raised right away: tasks that have not started yet are cancelled and locked projects
+    get released.
+    """
+    try:
+        with ThreadPoolExecutor(max_workers=ctx.max_workers) as executor:
+            futures = [executor.submit(func, item) for item in items]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except Exception:
+                # tasks that are already running will be finished when leaving the executor
+                for future in futures:
+                    future.cancel()
+                raise
+        return [future.result() for future in futures]
+    except Exception:
+        if not ctx.skip_lock:
+            ctx.project_padlock.unlock_all()
+        raise
+
+
+def load_last_run(master_wp_dir):
+    """Returns state of WP projects recorded by the last run (or empty dict if there was no previous run)"""
+    last_run_file = os.path.join(master_wp_dir, "last_run.json")
+    if not os.path.exists(last_run_file):
+        return {}
+    with open(last_run_file, "r") as f:
+        return json.load(f)
+
+
+def save_last_run(master_wp_dir, last_run):
+    """Writes state of WP projects, so that the next run can skip the projects that have not changed"""
+    last_run_file = os.path.join(master_wp_dir, "last_run.json")
+    if os.path.lexists(last_run_file):
+        os.remove(last_run_file)  # may be a hard link to the cache
+    with open(last_run_file, "w") as f:
+        json.dump(last_run, f, indent=2, sort_keys=True)
+
+
 def get_master_project_files(directory):
     """Returns list of relative file names from the master project that should be copied to the new WP projects"""
-    mergin_internal_dir = os.path.join(directory, ".mergin")
-    config_file = os.path.join(directory, "mergin-work-packages.yml")
-    wp_dir = os.path.join(directory, "work-packages")
     files = []
-    for filename in glob.iglob(os.path.join(directory, "**"), recursive=True):
-        if filename.startswith(mergin_internal_dir) or filename.startswith(wp_dir) or filename == config_file:
-            continue
-        if not os.path.isfile(filename):
-            continue
-        filename_relative = filename[len(directory) + 1 :]  # remove prefix
-        if len(filename_relative):
-            files.append(filename_relative)
+
+    def _scan(dir_path, relative_dir):
+        # like glob, silently skip directories that cannot be listed (no permission, symlink loops, ...)
+        try:
+            with os.scandir(dir_path) as it:
+                entries = list(it)
+        except OSError:
+            return
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue  # hidden files and directories (including .mergin) are skipped
+            # at the top level, skip the config and anything starting with "work-packages" (not just the directory)
+            if not relative_dir and (
+                entry.name.startswith("work-packages") or entry.name == "mergin-work-packages.yml"
+            ):
+                continue
+            relative_path = os.path.join(relative_dir, entry.name)
+            try:
+                is_dir = entry.is_dir()  # symlinks to directories are followed
+                is_file = not is_dir and entry.is_file()  # broken symlinks are skipped
+            except OSError:
+                continue
+            if is_dir:
+                _scan(entry.path, relative_path)
+            elif is_file:
+                files.append(relative_path)
+
+    _scan(directory, "")
     return files
 
 
+def copy_master_files(master_dir, wp_dir, master_project_files):
+    """
+    Adds files from the master project to a new WP project. Files are hard-linked (if possible),
+    because they are never modified in either of the projects before they get pushed.
+    """
+    # create each sub-directory just once (not for every file in it)
+    for relative_dir in {os.path.dirname(relative_filepath) for relative_filepath in master_project_files}:
+        os.makedirs(os.path.join(wp_dir, relative_dir), exist_ok=True)
+    for relative_filepath in master_project_files:
+        print("Adding file from master project: " + relative_filepath)
+        src_path = os.path.join(master_dir, relative_filepath)
+        dst_path = os.path.join(wp_dir, relative_filepath)
+        link_file(src_path, dst_path)
+
+
 def prepare_inputs(ctx: MerginWPContext) -> (WPConfig, set, str, list):
     """
     Prepare directory with inputs:
@@ -151,41 +257,41 @@ def prepare_inputs(ctx: MerginWPContext) -> (WPConfig, set, str, list):
         print("No cache directory set: work packaging may be slow, it is recommended to use cache directory")
 
     print("Downloading master project " + ctx.master_mergin_project + "...")
-    download_project_with_cache(ctx.mc, ctx.master_mergin_project, ctx.master_dir, ctx.cache_dir)
+    download_project_with_cache(ctx.mc, ctx.master_mergin_project, ctx.master_dir, ctx.cache_dir, link=True)
     print("Done.")
 
     print("Reading configuration from " + ctx.master_config_yaml)
     wp_config = load_config_from_yaml(ctx.master_config_yaml)
+    ctx.last_run = load_last_run(ctx.master_wp_dir)
+    ctx.wp_dirs = {wp.name: os.path.join(ctx.tmp_dir, "wp-" + wp.name) for wp in wp_config.wp_names}
 
     # Handling removed work packages
     wp_names = {f"{wp.name}.gpkg" for wp in wp_config.wp_names}
-    master_wp_dir = os.path.join(ctx.master_dir, "work-packages")
-    if os.path.exists(master_wp_dir):
-        for f in os.listdir(master_wp_dir):
-            if f.endswith(".gpkg") and f != "master.gpkg" and f not in wp_names:
-                missing_wp_name = f[:-5]  # strip the suffix
-                print(f"Removing '{missing_wp_name}' work package as it's not used anymore.")
-                os.remove(os.path.join(master_wp_dir, f))
+    if os.path.exists(ctx.master_wp_dir):
+        # files are only moved away to a directory within the temporary dir - they get deleted together with it
+        # in the background by the next run (see trash_tmp_dir())
+        trash_dir = os.path.join(ctx.tmp_dir, "removed-work-packages")
+        with os.scandir(ctx.master_wp_dir) as entries:
+            for entry in entries:
+                f = entry.name
+                if f.endswith(".gpkg") and f != "master.gpkg" and f not in wp_names and entry.is_file():
+                    missing_wp_name = f[:-5]  # strip the suffix
+                    print(f"Removing '{missing_wp_name}' work package as it's not used anymore.")
+                    os.makedirs(trash_dir, exist_ok=True)
+                    os.rename(entry.path, os.path.join(trash_dir, f))
 
     gpkg_path = wp_config.master_gpkg
 
-    shutil.copy(os.path.join(ctx.master_dir, gpkg_path), os.path.join(ctx.wp_alg_input_dir, "master.gpkg"))
-
-    # the master.gpkg and remap.db should exist if this is not the first run of the tool
-    if os.path.exists(os.path.join(ctx.master_dir, "work-packages", "master.gpkg")):
-        shutil.copy(
-            os.path.join(ctx.master_dir, "work-packages", "master.gpkg"),
-            os.path.join(ctx.wp_alg_base_dir, "master.gpkg"),
-        )
-    if os.path.exists(os.path.join(ctx.master_dir, "work-packages", "remap.db")):
-        shutil.copy(
-            os.path.join(ctx.master_dir, "work-packages", "remap.db"), os.path.join(ctx.wp_alg_base_dir, "remap.db")
-        )
-
-    master_project_files = get_master_project_files(ctx.master_dir)
-    assert gpkg_path in master_project_files
-    master_project_files.remove(gpkg_path)
-    print("Master project files to copy to new projects: " + str(master_project_files))
+    copy_file(os.path.join(ctx.master_dir, gpkg_path), os.path.join(ctx.wp_alg_input_dir, "master.gpkg"))
+
+    # the master.gpkg and remap.db should exist if this is not the first run of the tool.
+    # Base files are only read by the algorithm (it makes its own copies when it needs to modify them),
+    # so they can be hard links instead of copies
+    for filename in ["master.gpkg", "remap.db"]:
+        base_file = os.path.join(ctx.master_wp_dir, filename)
+        if os.path.exists(base_file):
+            link_file(base_file, os.path.join(ctx.wp_alg_base_dir, filename))
+
     print("Fetching work packages projects info...")
     group_size = 50  # Maximum project names group size accepted by `get_projects_by_names`
     wp_names_groups = [wp_config.wp_names[i : i + group_size] for i in range(0, len(wp_config.wp_names), group_size)]
@@ -193,36 +299,68 @@ def prepare_inputs(ctx: MerginWPContext) -> (WPConfig, set, str, list):
     for wp_names_group in wp_names_groups:
         project_group_info = ctx.mc.get_projects_by_names([wp.mergin_project for wp in wp_names_group])
         wp_projects_info.update(project_group_info)
-    # list of WP names that did not exist previously (and we will have to create a new Mergin project for them)
-    wp_new = set()
 
-    def prepare_work_package(wp):
+    def prepare_work_package(task):
+        """Returns "new" for WPs without a base file, "unchanged" if download got skipped, "downloaded" otherwise"""
+        wp, wp_info = task
         wp_name, wp_value, wp_mergin = wp.name, wp.value, wp.mergin_project
-        wp_dir = os.path.join(ctx.tmp_dir, "wp-" + wp_name)
-        wp_base_file = os.path.join(ctx.master_dir, "work-packages", wp_name + ".gpkg")
+        wp_dir = ctx.wp_dirs[wp_name]
+        wp_base_file = os.path.join(ctx.master_wp_dir, wp_name + ".gpkg")
+        wp_input_file = os.path.join(ctx.wp_alg_input_dir, wp_name + ".gpkg")
         if os.path.exists(wp_base_file):  # already processed?
             print("Preparing work package " + wp_name)
-            shutil.copy(wp_base_file, os.path.join(ctx.wp_alg_base_dir, wp_name + ".gpkg"))
-            wp_info = wp_projects_info[wp_mergin]
-            try:
-                server_version = wp_info["version"]
-            except KeyError:
-                server_version = None
+            # the server reports projects that do not exist (or we have no access to) as {"error": <code>}
+            if wp_info is None or "error" in wp_info:
+                raise ValueError(
+                    f"Work package project {wp_mergin} (work package {wp_name}) does not exist or is not accessible"
+                )
+            server_version = wp_info.get("version")
+            link_file(wp_base_file, os.path.join(ctx.wp_alg_base_dir, wp_name + ".gpkg"))
+            wp_last_run = ctx.last_run.get(wp_name)
+            if (
+                server_version is not None
+                and wp_last_run is not None
+                and wp_last_run["version"] == server_version
+                and wp_last_run["checksum"] == file_checksum(wp_base_file)
+            ):
+                # nobody has pushed to the WP project since the last run, so its data are the same as the base file
+                print("Work package project " + wp_mergin + " not modified since the last run - skipping download")
+                copy_file(wp_base_file, wp_input_file)
+                if ctx.cache_dir:
+                    # the project is still in use - keep its cached copy
+                    touch_cache_entry(ctx.cache_dir, wp_mergin)
+                if not ctx.skip_lock:
+                    ctx.project_padlock.lock(wp_dir, wp_mergin, server_version)
+                return "unchanged"
             print("Downloading work package project " + wp_mergin + "...")
-            download_project_with_cache(ctx.mc, wp_mergin, wp_dir, ctx.cache_dir, server_latest_version=server_version)
+            download_project_with_cache(
+                ctx.mc, wp_mergin, wp_dir, ctx.cache_dir, server_latest_version=server_version, link=True
+            )
             print("Done.")
 
-            shutil.copy(os.path.join(wp_dir, gpkg_path), os.path.join(ctx.wp_alg_input_dir, wp_name + ".gpkg"))
+            copy_file(os.path.join(wp_dir, gpkg_path), wp_input_file)
             if not ctx.skip_lock:
                 ctx.project_padlock.lock(wp_dir)
+            return "downloaded"
         else:
             print("First time encountered WP " + wp_name + " - not collecting input")
-            wp_new.add(wp_name)
-
-    with ThreadPoolExecutor(max_workers=ctx.max_workers) as executor:
-        for result in executor.map(prepare_work_package, wp_config.wp_names):
-            if result:
-                print(result)
+            return "new"
+
+    # pair each WP with its project's info from the server
+    tasks = [(wp, wp_projects_info.get(wp.mergin_project)) for wp in wp_config.wp_names]
+    wp_states = dict(zip([wp.name for wp in wp_config.wp_names], run_in_parallel(ctx, prepare_work_package, tasks)))
+    # set of WP names that did not exist previously (and we will have to create a new Mergin project for them)
+    wp_new = {wp_name for wp_name, state in wp_states.items() if state == "new"}
+    ctx.wp_unchanged = {wp_name for wp_name, state in wp_states.items() if state == "unchanged"}
+
+    # other files from the master project only get copied to new WP projects - do not list them if there are none
+    if wp_new:
+        master_project_files = get_master_project_files(ctx.master_dir)
+        assert gpkg_path in master_project_files
+        master_project_files.remove(gpkg_path)
+        print("Master project files to copy to new projects: " + str(master_project_files))
+    else:
+        master_project_files = []
 
     if not ctx.skip_lock:
         ctx.project_padlock.lock(ctx.master_dir)
@@ -231,15 +369,16 @@ def prepare_inputs(ctx: MerginWPContext) -> (WPConfig, set, str, list):
 
 
 def push_mergin_project(mc, directory, max_retries=3, sleep_time=5):
+    """Pushes changes in the project directory. Returns the new project version or None if nothing was pushed."""
     push_attempt = 1
     while True:
         try:
             job = mergin.client_push.push_project_async(mc, directory)
             if job is None:
-                return False  # there is nothing to push (or we only deleted some files)
+                return None  # there is nothing to push (or we only deleted some files)
             mergin.client_push.push_project_wait(job)
             mergin.client_push.push_project_finalize(job)
-            return True
+            return job.mp.version()  # metadata have been already updated by finalize
         except mergin.ClientError:
             if push_attempt <= max_retries:
                 print(f"Push attempt number {push_attempt} failed. Retrying in {sleep_time} seconds...")
@@ -249,32 +388,84 @@ def push_mergin_project(mc, directory, max_retries=3, sleep_time=5):
                 raise
 
 
+def remove_tmp_dir(directory):
+    """Removes the temporary directory of the run (only reports failure, as the data have already been pushed)"""
+    try:
+        shutil.rmtree(directory)
+    except (PermissionError, OSError):
+        print(f"Couldn't remove temporary dir. Removing '{directory}' skipped.")
+
+
+def trash_tmp_dir(directory):
+    """
+    Moves the temporary directory of the run aside instead of removing it (removing lots of large files
+    may take a while). The next run removes it in the background - see remove_trash_dirs().
+    """
+    trash_dir = os.path.join(os.path.dirname(directory), TRASH_DIR_PREFIX + os.path.basename(directory))
+    try:
+        os.rename(directory, trash_dir)
+    except OSError:
+        remove_tmp_dir(directory)
+
+
+def remove_trash_dirs(parent_dir):
+    """Removes temporary directories moved aside by trash_tmp_dir() in previous runs"""
+    try:
+        with os.scandir(parent_dir) as entries:
+            trash_dirs = [
+                entry.path
+                for entry in entries
+                if entry.name.startswith(TRASH_DIR_PREFIX) and entry.is_dir(follow_symlinks=False)
+            ]
+    except OSError:
+        return
+    for trash_dir in trash_dirs:
+        remove_tmp_dir(trash_dir)
+
+
 def push_data_to_projects(ctx: MerginWPContext, wp_config, wp_new, gpkg_path, master_project_files):
     """Push data to all Mergin Maps projects"""
 
-    def push_work_package(wp):
+    def create_work_package_project(wp):
         wp_name, wp_value, wp_mergin = wp.name, wp.value, wp.mergin_project
-        wp_dir = os.path.join(ctx.tmp_dir, "wp-" + wp_name)
-        if wp_name in wp_new:
-            # we need to create new project
-            if not ctx.dry_run:
-                print("Creating project: " + wp_mergin + " for work package " + wp_name)
-                ctx.mc.create_project(wp_mergin, False)
-                download_project_with_cache(ctx.mc, wp_mergin, wp_dir, ctx.cache_dir)
-            else:
-                os.makedirs(wp_dir, exist_ok=True)  # Make WP project folder that would be created by the Mergin Client
-            shutil.copy(os.path.join(ctx.wp_alg_output_dir, wp_name + ".gpkg"), os.path.join(wp_dir, gpkg_path))
+        wp_dir = ctx.wp_dirs[wp_name]
+        if not ctx.dry_run:
+            print("Creating project: " + wp_mergin + " for work package " + wp_name)
+            ctx.mc.create_project(wp_mergin, False)
+            download_project_with_cache(ctx.mc, wp_mergin, wp_dir, ctx.cache_dir, link=True)
+        else:
+            os.makedirs(wp_dir, exist_ok=True)  # Make WP project folder that would be created by the Mergin Client
 
-            # copy other files from master project
-            for relative_filepath in master_project_files:
-                print("Adding file from master project: " + relative_filepath)
-                src_path = os.path.join(ctx.master_dir, relative_filepath)
-                dst_path = os.path.join(wp_dir, relative_filepath)
-                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-                shutil.copy(src_path, dst_path)
+        # copy other files from master project
+        copy_master_files(ctx.master_dir, wp_dir, master_project_files)
 
-        # new version of the geopackage
-        shutil.copy(os.path.join(ctx.wp_alg_output_dir, wp_name + ".gpkg"), os.path.join(wp_dir, gpkg_path))
+    def push_work_package(wp):
+        wp_name, wp_value, wp_mergin = wp.name, wp.value, wp.mergin_project
+        wp_dir = ctx.wp_dirs[wp_name]
+        wp_output_file = os.path.join(ctx.wp_alg_output_dir, wp_name + ".gpkg")
+        wp_gpkg_file = os.path.join(wp_dir, gpkg_path)
+        wp_output_checksum = file_checksum(wp_output_file)
+        if wp_name in ctx.wp_unchanged:
+            wp_last_run = ctx.last_run[wp_name]
+            if wp_output_checksum == wp_last_run["checksum"]:
+                print("No changes in work package " + wp_name + " (not creating a new version).")
+                if not ctx.skip_lock:
+                    ctx.project_padlock.unlock(wp_dir)
+                return
+            # the project was not downloaded when preparing inputs, but now we have new data to push
+            print("Downloading work package project " + wp_mergin + "...")
+            # the project has been locked at the version seen when preparing inputs, so the server version is known
+            # and an up-to-date cache does not need to ask the server again
+            server_version = None if ctx.skip_lock else wp_last_run["version"]
+            download_project_with_cache(
+                ctx.mc, wp_mergin, wp_dir, ctx.cache_dir, server_latest_version=server_version, link=True
+            )
+            print("Done.")
+            if mergin.MerginProject(wp_dir).version() != wp_last_run["version"]:
+                raise mergin.ClientError(f"Work package project {wp_mergin} has been modified during the run")
+
+        # new version of the geopackage (the output file does not get modified anymore, so it can be linked)
+        link_file(wp_output_file, wp_gpkg_file)
 
         if ctx.dry_run:
             print(f"This is a dry run - no changes pushed for work package: {wp_name}")
@@ -282,33 +473,34 @@ def push_data_to_projects(ctx: MerginWPContext, wp_config, wp_new, gpkg_path, ma
         print("Uploading new version of the project: " + wp_mergin + " for work package " + wp_name)
         if not ctx.skip_lock:
             ctx.project_padlock.unlock(wp_dir)
-        if push_mergin_project(ctx.mc, wp_dir):
-            print("Uploaded a new version: " + mergin.MerginProject(wp_dir).version())
+        version = push_mergin_project(ctx.mc, wp_dir)
+        if version is not None:
+            print("Uploaded a new version: " + version)
         else:
             print("No changes (not creating a new version).")
+            version = mergin.MerginProject(wp_dir).version()
+        ctx.last_run[wp_name] = {"version": version, "checksum": wp_output_checksum}
+
+    # first create projects for all new work packages, so that their uploads do not wait for it one by one
+    run_in_parallel(ctx, create_work_package_project, [wp for wp in wp_config.wp_names if wp.name in wp_new])
 
-    with ThreadPoolExecutor(max_workers=ctx.max_workers) as executor:
-        for result in executor.map(push_work_package, wp_config.wp_names):
-            if result:
-                print(result)
+    run_in_parallel(ctx, push_work_package, wp_config.wp_names)
 
     # in the last step, let's update the master project
     # (update the master database file and update base files for work packages)
-    shutil.copy(os.path.join(ctx.wp_alg_output_dir, "master.gpkg"), os.path.join(ctx.master_dir, gpkg_path))
-    if not os.path.exists(os.path.join(ctx.master_dir, "work-packages")):
-        os.makedirs(os.path.join(ctx.master_dir, "work-packages"))
-    shutil.copy(
-        os.path.join(ctx.wp_alg_output_dir, "master.gpkg"), os.path.join(ctx.master_dir, "work-packages", "master.gpkg")
+    if not os.path.exists(ctx.master_wp_dir):
+        os.makedirs(ctx.master_wp_dir)
+    # all databases from the output (master.gpkg, remap.db, <WP>.gpkg) become base files for the next run.
+    # The output files are not modified anymore, so all the copies can share the data (as hard links)
+    with os.scandir(ctx.wp_alg_output_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith((".gpkg", ".db")) and entry.is_file():
+                link_file(entry.path, os.path.join(ctx.master_wp_dir, entry.name))
+    link_file(os.path.join(ctx.wp_alg_output_dir, "master.gpkg"), os.path.join(ctx.master_dir, gpkg_path))
+    # only keep work packages that are still in use
+    save_last_run(
+        ctx.master_wp_dir, {wp.name: ctx.last_run[wp.name] for wp in wp_config.wp_names if wp.name in ctx.last_run}
     )
-    shutil.copy(
-        os.path.join(ctx.wp_alg_output_dir, "remap.db"), os.path.join(ctx.master_dir, "work-packages", "remap.db")
-    )
-    for wp in wp_config.wp_names:
-        wp_name, wp_value, wp_mergin = wp.name, wp.value, wp.mergin_project
-        shutil.copy(
-            os.path.join(ctx.wp_alg_output_dir, wp_name + ".gpkg"),
-            os.path.join(ctx.master_dir, "work-packages", wp_name + ".gpkg"),
-        )
 
     if ctx.dry_run:
         print(f"This is a dry run - no changes pushed into the master project: {ctx.master_mergin_project}")
@@ -316,31 +508,38 @@ def push_data_to_projects(ctx: MerginWPContext, wp_config, wp_new, gpkg_path, ma
         print("Uploading new version of the master project: " + ctx.master_mergin_project)
         if not ctx.skip_lock:
             ctx.project_padlock.unlock(ctx.master_dir)
-        if push_mergin_project(ctx.mc, ctx.master_dir):
-            print("Uploaded a new version: " + mergin.MerginProject(ctx.master_dir).version())
+        version = push_mergin_project(ctx.mc, ctx.master_dir)
+        if version is not None:
+            print("Uploaded a new version: " + version)
         else:
             print("No changes (not creating a new version).")
-    try:
-        shutil.rmtree(ctx.tmp_dir)
-    except (PermissionError, OSError):
-        print(f"Couldn't remove temporary dir. Removing '{ctx.tmp_dir}' skipped.")
     # Release locked projects if any left - just in case
     if not ctx.skip_lock:
         ctx.project_padlock.unlock_all()
-    print("Done.")
 
 
 def run_wp_mergin_with_context(ctx: MerginWPContext):
     initialize(ctx)
-    wp_config, wp_new, gpkg_path, master_project_files = prepare_inputs(ctx)
-    make_work_packages(ctx.wp_alg_dir, wp_config)
-    push_data_to_projects(ctx, wp_config, wp_new, gpkg_path, master_project_files)
+    try:
+        wp_config, wp_new, gpkg_path, master_project_files = prepare_inputs(ctx)
+        make_work_packages(ctx.wp_alg_dir, wp_config, ctx.max_workers)
+        push_data_to_projects(ctx, wp_config, wp_new, gpkg_path, master_project_files)
+        # nothing needs the temporary files anymore - leave them to the next run
+        trash_tmp_dir(ctx.tmp_dir)
+        if ctx.cache_dir and ctx.cache_max_size is not None:
+            # projects used in this run are kept in the cache even if the limit is exceeded
+            evict_cache(ctx.cache_dir, ctx.cache_max_size * 1024 * 1024, ctx.start_time)
+    finally:
+        # removal of the previous temporary directories normally finishes during downloads already
+        ctx.trash_cleanup.join()
+    print("Done.")
 
 
-def run_wp_mergin(mergin_project, cache_dir=None, dry_run=False):
+def run_wp_mergin(mergin_project, cache_dir=None, dry_run=False, cache_max_size=None):
     """This function can be used to run work packaging from other Python scripts"""
     ctx = MerginWPContext()
     ctx.master_mergin_project = mergin_project
     ctx.cache_dir = cache_dir
+    ctx.cache_max_size = cache_max_size
     ctx.dry_run = dry_run
     run_wp_mergin_with_context(ctx)
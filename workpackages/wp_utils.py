@@ -7,20 +7,229 @@ import hashlib
 import mergin
 import os
 import shutil
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# ioctl request for cloning a file (from <linux/fs.h>)
+FICLONE = 0x40049409
+
+# checksum of the dummy file "uploaded" when locking projects (it never gets uploaded, so any value would do)
+_EMPTY_SHA1 = "da39a3ee5e6b4b0d3255bfef95601890afd80709"  # == hashlib.sha1().hexdigest()
 
 
 def escape_double_quotes(name):
+    if '"' not in name:
+        return f'"{name}"'  # the usual case - nothing to escape
     escaped_name = name.replace('"', '""')
     quoted_name = f'"{escaped_name}"'
     return quoted_name
 
 
-def download_project_with_cache(mc, project_path, directory, cache_dir, version=None, server_latest_version=None):
+# pairs of (source, destination) device IDs where cloning files failed - it is not tried again for them
+_no_clone_devices = set()
+
+
+def _clone_file(src, dst):
+    """
+    Tries to create the destination as a copy-on-write clone of the source file (reflink), which only
+    shares the data blocks instead of copying them. Returns False if the OS or file system does not support it.
+    """
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(os.path.abspath(dst))).st_dev)
+    if devices in _no_clone_devices:
+        return False
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        try:
+            fcntl.ioctl(f_dst.fileno(), FICLONE, f_src.fileno())
+        except OSError:
+            _no_clone_devices.add(devices)
+            return False
+    return True
+
+
+def _copy_file_range(src, dst):
+    """
+    Copies the file with copy_file_range() system call, which lets the kernel (or the file system itself,
+    e.g. NFS server-side copy) do the copying. Returns False if it is not supported.
+    """
+    if not hasattr(os, "copy_file_range"):  # Linux only, Python >= 3.8
+        return False
+    with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+        remaining = os.fstat(f_src.fileno()).st_size
+        while remaining > 0:
+            try:
+                copied = os.copy_file_range(f_src.fileno(), f_dst.fileno(), min(remaining, 1024 * 1024 * 1024))
+            except OSError:
+                return False
+            if copied == 0:
+                # the file got shorter or (more likely) the file system does not support it (e.g. FUSE, procfs)
+                return False
+            remaining -= copied
+    return True
+
+
+def copy_file(src, dst):
+    """
+    Copies a file (including its permission bits and times) to the destination path.
+    On file systems with copy-on-write support (e.g. Btrfs, XFS) the copy is a cheap reflink,
+    otherwise the data get copied in the kernel by copy_file_range() or by shutil.copyfile().
+
+    An existing destination file is removed first rather than overwritten in place: it may be
+    a hard link to a file in the cache directory, and the cached copy must stay untouched.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if not _clone_file(src, dst) and not _copy_file_range(src, dst):
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def link_file(src, dst):
+    """
+    Makes the destination path a hard link to the source file (replacing any existing destination),
+    falling back to copy_file() if hard links are not possible. Only use this for files that are not
+    going to be modified in place afterwards.
+    """
+    if os.path.lexists(dst):
+        if os.path.exists(dst) and os.path.samefile(src, dst):
+            return  # already linked
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy_file(src, dst)
+
+
+def file_checksum(path):
+    """Returns SHA-256 checksum (hex digest) of the file's content"""
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):  # not available on Windows and macOS
+            # the whole file is read just once from start to end - let the kernel read ahead more aggressively
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        if hasattr(hashlib, "file_digest"):  # Python >= 3.11: reads into a reused buffer, without copying chunks
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        checksum = hashlib.sha256()
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def _link_tree(src_dir, dst_dir):
+    """
+    Recreates a cached project directory using hard links instead of copying the data.
+    The .mergin metadata directory is always copied, because Mergin Maps client modifies
+    those files in place (metadata, basefiles, logs) and that must not leak back to the cache.
+    If hard links cannot be created (e.g. the directories are on different file systems),
+    the remaining files get copied.
+    """
+    can_link = True
+
+    def _link_or_copy(src, dst):
+        nonlocal can_link
+        if can_link:
+            try:
+                os.link(src, dst)
+                return
+            except OSError:
+                can_link = False  # no point in trying again for every other file
+        copy_file(src, dst)
+
+    mergin_internal_dir = os.path.join(src_dir, ".mergin")
+    shutil.copytree(
+        src_dir,
+        dst_dir,
+        copy_function=_link_or_copy,
+        ignore=lambda d, names: [".mergin"] if d == src_dir else [],
+    )
+    if os.path.exists(mergin_internal_dir):
+        # basefiles may be large geopackages - use reflinks where possible
+        shutil.copytree(mergin_internal_dir, os.path.join(dst_dir, ".mergin"), copy_function=copy_file)
+
+
+def _open_cache_index(cache_dir):
+    """Opens the index of the cache directory, which records when each cached project has been used last time"""
+    db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60, isolation_level=None)
+    db.execute("CREATE TABLE IF NOT EXISTS entries (project_path TEXT PRIMARY KEY, dir TEXT, last_used REAL)")
+    return db
+
+
+def _dir_size(directory):
+    """Returns total size of files in the directory (in bytes)"""
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def _project_cache_dir(cache_dir, project_path):
+    """Returns directory where the given Mergin Maps project is kept in the cache directory"""
+    project_namespace, project_name = project_path.split("/")
+    return os.path.join(cache_dir, f"{project_namespace}_{project_name}")
+
+
+def touch_cache_entry(cache_dir, project_path):
+    """Records that the cached project has been used now, so that evict_cache() keeps it as long as possible"""
+    db = _open_cache_index(cache_dir)
+    try:
+        db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?)",
+            (project_path, _project_cache_dir(cache_dir, project_path), time.time()),
+        )
+    finally:
+        db.close()
+
+
+def evict_cache(cache_dir, max_size, used_since):
+    """
+    Removes least recently used projects from the cache directory until the total size of cached projects
+    is at most max_size bytes. Projects used since the given time (e.g. during the current run) are always kept.
+    Directories cached by older versions of the tool (missing in the index) are treated as last used
+    at their modification time.
+    """
+    db = _open_cache_index(cache_dir)
+    try:
+        entries = db.execute("SELECT project_path, dir, last_used FROM entries").fetchall()
+        indexed_dirs = {os.path.normpath(directory) for _, directory, _ in entries}
+        with os.scandir(cache_dir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False) and os.path.normpath(entry.path) not in indexed_dirs:
+                    entries.append((entry.name, entry.path, entry.stat(follow_symlinks=False).st_mtime))
+        entries.sort(key=lambda e: e[2])
+        sizes = {directory: _dir_size(directory) for _, directory, _ in entries}
+        total_size = sum(sizes.values())
+        for project_path, directory, last_used in entries:
+            if total_size <= max_size or last_used >= used_since:
+                break
+            print(f"Removing '{project_path}' project from the cache")
+            shutil.rmtree(directory, ignore_errors=True)
+            db.execute("DELETE FROM entries WHERE dir = ?", (directory,))
+            total_size -= sizes[directory]
+    finally:
+        db.close()
+
+
+def download_project_with_cache(
+    mc, project_path, directory, cache_dir, version=None, server_latest_version=None, link=False
+):
+    """
+    Downloads Mergin Maps project to the given directory. If the cache directory is set, the project
+    is first downloaded (or pulled) there and then copied to the destination. With link=True the files
+    are hard-linked from the cache instead of copied - the caller must then never modify files
+    in place (use copy_file() to replace them).
+    """
     if not cache_dir:
         mc.download_project(project_path, directory, version=version)
         return
-    project_namespace, project_name = project_path.split("/")
-    project_cache_dir = os.path.join(cache_dir, f"{project_namespace}_{project_name}")
+    project_cache_dir = _project_cache_dir(cache_dir, project_path)
     if not os.path.exists(project_cache_dir):
         mc.download_project(project_path, project_cache_dir, version=version)
     else:
@@ -30,7 +239,11 @@ def download_project_with_cache(mc, project_path, directory, cache_dir, version=
         else:
             print(f"Local and server project versions are the same. Pulling '{project_path}' project skipped")
         print("Project cached - copying existing files")
-    shutil.copytree(project_cache_dir, directory)
+    touch_cache_entry(cache_dir, project_path)
+    if link:
+        _link_tree(project_cache_dir, directory)
+    else:
+        shutil.copytree(project_cache_dir, directory, copy_function=copy_file)
 
 
 class ProjectPadlock:
@@ -39,19 +252,24 @@ class ProjectPadlock:
     This allows to prevent editing projects by other users while mergin-work-packages script is running.
     """
 
-    def __init__(self, mc):
+    def __init__(self, mc, max_workers=None):
         self.mc = mc
+        self.max_workers = max_workers
         self.locked_projects = {}
 
-    def lock(self, directory):
+    def lock(self, directory, project_path=None, local_version=None):
+        """
+        Locks project downloaded in the directory. Project path and version may be also passed explicitly
+        if the project has not been downloaded (yet) - the directory is then only used as a key for unlock().
+        """
         print(f"--- locking dir: '{directory}'")
-        mp = mergin.MerginProject(directory)
-        project_path = mp.project_full_name()
-        local_version = mp.version()
+        if project_path is None or local_version is None:
+            mp = mergin.MerginProject(directory)
+            project_path = mp.project_full_name()
+            local_version = mp.version()
         size = 1
-        checksum = hashlib.sha1().hexdigest()
         changes = {
-            "added": [{"path": "lock.txt", "size": size, "checksum": checksum}],
+            "added": [{"path": "lock.txt", "size": size, "checksum": _EMPTY_SHA1}],
             "updated": [],
             "removed": [],
         }
@@ -81,5 +299,6 @@ class ProjectPadlock:
 
     def unlock_all(self):
         print(f"Number of locked projects left: {len(self.locked_projects)}")
-        for directory in list(self.locked_projects.keys()):
-            self.unlock(directory)
+        # there is no API to release multiple projects at once - at least send the requests in parallel
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            list(executor.map(self.unlock, list(self.locked_projects.keys())))